@@ -1,9 +1,20 @@
 #!/usr/bin/env python3
 
-import argparse, os, re, codecs, requests, gzip
-from collections import defaultdict
+import argparse, os, codecs, json, mmap, requests, gzip, tempfile, unicodedata
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime, timedelta
-from prettytable import PrettyTable
+from requests.adapters import HTTPAdapter
+
+try:
+    import re2 as re
+except ImportError:
+    import re
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 ### CONSTANTS ###
 
@@ -11,204 +22,305 @@ DEFAULT_LOGDIR = '~/.lnd/logs/bitcoin/mainnet'
 DEFAULT_RESTSERVER = 'localhost:8080'
 DEFAULT_TLSCERT = '~/.lnd/tls.cert'
 DEFAULT_MACAROON = '~/.lnd/data/chain/bitcoin/mainnet/admin.macaroon'
+NODE_CACHE_PATH = '~/.cache/audit-lnd/nodes.json'
+NODE_CACHE_TTL = timedelta(hours=24)
 DESCRIPTION = 'audit lnd'
-REGEX_LOG_START = r'^(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2})\..+'
-REGEX_BANDWIDTH_FAILURE = r'ChannelLink\((.+)\): insufficient bandwidth to route htlc: (\d+) mSAT'
-REGEX_REMOTE_FAILURE = r'ChannelLink\((.+)\): Failed to send (\d+) mSAT'
-REGEX_WATCHTOWER_PEERS = r'WTWR: Accepted incoming peer .+@(.+):\d+'
-REGEX_WTCLIENT_FAILURES = r'WTCL: .+ unable to dial tower at any available Addresses:.+->(.+:\d+): (.+)'
+REGEX_LOG_START = re.compile(rb'(?m)^(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2})\..+')
+REGEX_BANDWIDTH_FAILURE = re.compile(rb'ChannelLink\((.+)\): insufficient bandwidth to route htlc: (\d+) mSAT')
+REGEX_REMOTE_FAILURE = re.compile(rb'ChannelLink\((.+)\): Failed to send (\d+) mSAT')
+REGEX_WATCHTOWER_PEERS = re.compile(rb'WTWR: Accepted incoming peer .+@(.+):\d+')
+REGEX_WTCLIENT_FAILURES = re.compile(rb'WTCL: .+ unable to dial tower at any available Addresses:.+->(.+:\d+): (.+)')
+REGEX_GZ_LOGFILE = re.compile(r'lnd\.log\.(\d+)\.gz')
+LOG_EVENTS = {
+    'bandwidth-failures': REGEX_BANDWIDTH_FAILURE,
+    'remote-failures': REGEX_REMOTE_FAILURE,
+    'watchtower-peers': REGEX_WATCHTOWER_PEERS,
+    'wtclient-failures': REGEX_WTCLIENT_FAILURES,
+}
+COMMAND_TITLES = {
+    'bandwidth-failures': 'Bandwidth failures',
+    'remote-failures': 'Remote failures',
+    'watchtower-peers': 'Watchtower peers',
+    'wtclient-failures': 'Watchtower client failures',
+}
 
 ### GLOBAL VARIABLES ###
 
 settings = {}
 channel_point_map = {}
+session = requests.Session()
+session.mount('https://', HTTPAdapter(pool_connections=32, pool_maxsize=32))
 
 ### FUNCTIONS ###
 
 def parse_args():
     parser = argparse.ArgumentParser(description=DESCRIPTION)
-    parser.add_argument('cmd', help='the command to execute {bandwidth-failures, remote-failures, watchtower-peers, wtclient-failures}')
+    parser.add_argument('cmd', nargs='+', choices=LOG_EVENTS, metavar='cmd', help='the command(s) to execute {bandwidth-failures, remote-failures, watchtower-peers, wtclient-failures}')
     parser.add_argument('--days', help='days back to search log (default=1)', default=1, type=int)
     parser.add_argument('--logdir', metavar='/path/to/logdir', help=f'lnd log dir path (default={DEFAULT_LOGDIR})', default=DEFAULT_LOGDIR)
     parser.add_argument('--restserver', metavar='host:port', help=f'lnd rest server (default={DEFAULT_RESTSERVER})', default=DEFAULT_RESTSERVER)
     parser.add_argument('--tlscert', metavar='/path/to/tls.cert', help=f'lnd tls cert path (default={DEFAULT_TLSCERT})', default=DEFAULT_TLSCERT)
     parser.add_argument('--macaroon', metavar='/path/to/macaroon', help=f'lnd macaroon path (default={DEFAULT_MACAROON})', default=DEFAULT_MACAROON)
+    parser.add_argument('--no-cache', help=f'do not use the cached node aliases in {NODE_CACHE_PATH}', action='store_true')
     args = parser.parse_args()
     settings['now'] = datetime.now()
     settings['days'] = args.days
     settings['days_back'] = timedelta(days = args.days)
+    settings['cutoff'] = settings['now'] - settings['days_back']
+    settings['cutoff_log_time'] = settings['cutoff'].strftime('%Y-%m-%d %H:%M:%S').encode('ascii')
     settings['logdir'] = os.path.expanduser(args.logdir)
     settings['rest_baseurl'] = 'https://' + args.restserver
     settings['tlscert'] = os.path.expanduser(args.tlscert)
+    settings['node_cache'] = None if args.no_cache else os.path.expanduser(NODE_CACHE_PATH)
     macaroon_path = os.path.expanduser(args.macaroon)
     macaroon = codecs.encode(open(macaroon_path, 'rb').read(), 'hex')
     settings['rest_headers'] = {'Grpc-Metadata-macaroon': macaroon}
     return args.cmd
 
 def collect_channel_data():
-    for channel in get_channels():
-        peer_alias = get_node_info(channel['remote_pubkey'])['node']['alias']
-        channel['peer_alias'] = peer_alias
+    channels = get_channels()
+    node_cache = load_node_cache()
+    now = settings['now'].timestamp()
+    expired = now - NODE_CACHE_TTL.total_seconds()
+    pubkeys = list({channel['remote_pubkey'] for channel in channels
+                    if node_cache.get(channel['remote_pubkey'], {}).get('cached_at', 0) < expired})
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        for pubkey, node_info in zip(pubkeys, executor.map(get_node_info, pubkeys)):
+            node_cache[pubkey] = {'alias': node_info['node']['alias'], 'cached_at': now}
+    for channel in channels:
+        channel['peer_alias'] = node_cache[channel['remote_pubkey']]['alias']
         channel_point_map[channel['channel_point']] = channel
+    if pubkeys:
+        save_node_cache(node_cache)
+
+def load_node_cache():
+    if not settings['node_cache']:
+        return {}
+    try:
+        with open(settings['node_cache'], 'r') as cache_file:
+            node_cache = json.load(cache_file)
+    except (OSError, ValueError):
+        return {}
+    if not isinstance(node_cache, dict) or not all(is_node_cache_entry(entry) for entry in node_cache.values()):
+        return {}
+    return node_cache
+
+def is_node_cache_entry(entry):
+    return (isinstance(entry, dict) and isinstance(entry.get('alias'), str)
+            and isinstance(entry.get('cached_at'), (int, float)))
+
+def save_node_cache(node_cache):
+    if not settings['node_cache']:
+        return
+    cache_dir = os.path.dirname(settings['node_cache'])
+    os.makedirs(cache_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as cache_file:
+            json.dump(node_cache, cache_file)
+        os.replace(tmp_path, settings['node_cache'])
+    except:
+        os.remove(tmp_path)
+        raise
 
 def get_channels():
     url = settings['rest_baseurl'] + '/v1/channels'
-    res = requests.get(url, headers=settings['rest_headers'], verify=settings['tlscert'])
-    return res.json()['channels']
+    res = session.get(url, headers=settings['rest_headers'], verify=settings['tlscert'])
+    return parse_json(res)['channels']
 
 def get_node_info(pubkey):
     url = settings['rest_baseurl'] + f'/v1/graph/node/{pubkey}'
-    res = requests.get(url, headers=settings['rest_headers'], verify=settings['tlscert'])
+    res = session.get(url, headers=settings['rest_headers'], verify=settings['tlscert'])
+    return parse_json(res)
+
+def parse_json(res):
+    if orjson:
+        return orjson.loads(res.content)
     return res.json()
 
-def get_logs():
-    logs = []
-    used_all_logs = True
-    with open(settings['logdir'] + '/lnd.log', 'r') as logfile:
-        used_all_logs = parse_log_file(logfile, logs)
-    if used_all_logs:
-        used_all_logs = parse_gz_log_files(logs)
-    if used_all_logs:
-        last_log_time = re.match(REGEX_LOG_START, logs[len(logs)-1]).group(1)
-        print(f'Warning - Logs might not go back far enough for {settings["days"]} days. Last log time found was: {last_log_time}')
+def scan_logs(events):
+    matches = {event: [] for event in events}
+    log_time, hit_cutoff = scan_active_log_file(settings['logdir'] + '/lnd.log', events, matches)
+    if not hit_cutoff:
+        gz_log_time, hit_cutoff = scan_gz_log_files(events, matches)
+        log_time = gz_log_time or log_time
+    if not hit_cutoff and log_time:
+        print(f'Warning - Logs might not go back far enough for {settings["days"]} days. Last log time found was: {log_time}')
         print('Suggestion: Use configs maxlogfiles and maxlogfilesize to adjust how much logs are saved')
-    return logs
+    return matches
 
-def parse_log_file(logfile, parsed_logs):
-    for line in reversed(list(logfile)):
-        if not re.match(REGEX_LOG_START, line):
-            continue
-        try:
-            log_time = datetime.strptime(line.split('.')[0], '%Y-%m-%d %H:%M:%S')
-            if settings['now'] - log_time > settings['days_back']:
-                return False
-            parsed_logs.append(line)
-        except:
-            print('Error - Failed to parse: ' + line)
-    return True
-
-def parse_gz_log_files(logs):
+def scan_active_log_file(path, events, matches):
+    with open(path, 'rb') as logfile:
+        stat = os.fstat(logfile.fileno())
+        if stat.st_mtime < settings['cutoff'].timestamp():
+            return None, True
+        if stat.st_size == 0:
+            return None, False
+        with mmap.mmap(logfile.fileno(), 0, access=mmap.ACCESS_READ) as log_map:
+            found, log_time, hit_cutoff = scan_log_buffer(log_map, events, settings['cutoff_log_time'])
+    for event, values in found.items():
+        matches[event].extend(values)
+    return log_time, hit_cutoff
+
+def scan_gz_log_files(events, matches):
     gz_logfiles = []
     for file_name in os.listdir(settings['logdir']):
-        match = re.match(r'lnd\.log\.(\d+)\.gz', file_name)
+        match = REGEX_GZ_LOGFILE.match(file_name)
         if match:
             gz_count = int(match.group(1))
             gz_logfiles.append((gz_count, file_name))
+    gz_paths = []
+    skipped_old_files = False
     for n, gz_logfile in sorted(gz_logfiles, reverse=True):
-        with gzip.open(settings['logdir'] + '/' + gz_logfile, 'r') as b_logfile:
-            logfile = [line.decode('utf-8') for line in b_logfile]
-            used_all_logs = parse_log_file(logfile, logs)
-            if not used_all_logs:
-                return False
-    return True
-
-def routing_failures(regex):
-    res = parse_routing_failures(regex)
-    table = PrettyTable()
-    table.field_names = ['Peer alias', 'Count', 'Total sats', 'Avarage tx', 'Min tx', 'Max tx', 'Capacity', 'Channel ID']
-    table.align['Peer alias'] = 'l'
-    table.align['Count'] = 'r'
-    table.align['Total sats'] = 'r'
-    table.align['Avarage tx'] = 'r'
-    table.align['Min tx'] = 'r'
-    table.align['Max tx'] = 'r'
-    table.align['Capacity'] = 'r'
-    table.align['Channel ID'] = 'c'
-    table.sortby = 'Count'
-    table.reversesort = True
-    for channel_point, values in res.items():
+        gz_path = settings['logdir'] + '/' + gz_logfile
+        if os.stat(gz_path).st_mtime < settings['cutoff'].timestamp():
+            skipped_old_files = True
+            break
+        gz_paths.append(gz_path)
+    log_time = None
+    if not gz_paths:
+        return log_time, skipped_old_files
+    with ProcessPoolExecutor() as executor:
+        futures = [executor.submit(scan_gz_log_file, gz_path, events, settings['cutoff_log_time']) for gz_path in gz_paths]
+        for future in futures:
+            found, file_log_time, hit_cutoff = future.result()
+            for event, values in found.items():
+                matches[event].extend(values)
+            log_time = file_log_time or log_time
+            if hit_cutoff:
+                for pending in futures:
+                    pending.cancel()
+                return log_time, True
+    return log_time, skipped_old_files
+
+def scan_gz_log_file(path, events, cutoff_log_time):
+    with gzip.open(path, 'rb') as logfile:
+        return scan_log_buffer(logfile.read(), events, cutoff_log_time)
+
+def scan_log_buffer(buf, events, cutoff_log_time):
+    offset, hit_cutoff = find_cutoff_offset(buf, cutoff_log_time)
+    first_line = REGEX_LOG_START.match(buf, offset)
+    log_time = first_line.group(1).decode() if first_line else None
+    combined, event_groups = compile_log_events(events)
+    found = {event: [] for event in events}
+    for match in combined.finditer(buf, offset):
+        event, groups = event_groups[match.lastindex]
+        found[event].append(match.groups()[match.lastindex:match.lastindex + groups])
+    return found, log_time, hit_cutoff
+
+def find_cutoff_offset(buf, cutoff_log_time):
+    low, high = 0, len(buf)
+    while low < high:
+        middle = (low + high) // 2
+        match = REGEX_LOG_START.search(buf, middle)
+        if match and match.group(1) < cutoff_log_time:
+            low = middle + 1
+        else:
+            high = middle
+    match = REGEX_LOG_START.search(buf, low)
+    return (match.start() if match else len(buf)), low > 0
+
+def compile_log_events(events):
+    patterns = []
+    event_groups = {}
+    group = 1
+    for event in events:
+        regex = LOG_EVENTS[event]
+        patterns.append(b'(' + regex.pattern + b')')
+        event_groups[group] = (event, regex.groups)
+        group += regex.groups + 1
+    return re.compile(b'|'.join(patterns)), event_groups
+
+def routing_failures(title, matches):
+    res = parse_routing_failures(matches)
+    rows = []
+    for channel_point, amounts in res.items():
         channel_id = channel_point_map[channel_point]['chan_id']
         capacity = int(channel_point_map[channel_point]['capacity'])
         peer_alias = channel_point_map[channel_point]['peer_alias']
-        count = values['count']
-        total = int(values["total"]/1000)
+        count = len(amounts)
+        total = int(sum(amounts)/1000)
         avgtx = int(total/count)
-        mintx = int(values['min']/1000)
-        maxtx = int(values['max']/1000)
-        table.add_row([peer_alias, count, f'{total:,}', f'{avgtx:,}', f'{mintx:,}', f'{maxtx:,}', f'{capacity:,}', channel_id])
-    print()
-    print(table)
-    print()
+        mintx = int(min(amounts)/1000)
+        maxtx = int(max(amounts)/1000)
+        rows.append([peer_alias, count, f'{total:,}', f'{avgtx:,}', f'{mintx:,}', f'{maxtx:,}', f'{capacity:,}', channel_id])
+    print_table(title, ['Peer alias', 'Count', 'Total sats', 'Avarage tx', 'Min tx', 'Max tx', 'Capacity', 'Channel ID'], 'lrrrrrrc', rows, 1)
 
-def parse_routing_failures(regex):
-    res = defaultdict(lambda:{'count': 0, 'total': 0, 'min': 0, 'max': 0})
-    for line in get_logs():
-        match = re.search(regex, line)
-        if match:
-            channel_point = match.group(1)
-            if not channel_point in channel_point_map:
-                continue
-            amount = int(match.group(2))
-            res[channel_point]['count'] += 1
-            res[channel_point]['total'] += amount
-            if res[channel_point]['min'] == 0 or amount < res[channel_point]['min']:
-                res[channel_point]['min'] = amount
-            if amount > res[channel_point]['max']:
-                res[channel_point]['max'] = amount
+def parse_routing_failures(matches):
+    res = defaultdict(list)
+    for channel_point, amount in matches:
+        channel_point = channel_point.decode()
+        if not channel_point in channel_point_map:
+            continue
+        res[channel_point].append(int(amount))
     return res
 
-def watchtower_peers():
-    res = parse_watchtower_connections()
-    table = PrettyTable()
-    table.field_names = ['Peer', 'Connections']
-    table.align['Peer'] = 'l'
-    table.align['Connections'] = 'r'
-    table.sortby = 'Connections'
-    table.reversesort = True
-    for peer_ip, connections in res.items():
-        table.add_row([peer_ip, connections])
-    print()
-    print(table)
-    print()
+def watchtower_peers(title, matches):
+    res = parse_watchtower_connections(matches)
+    rows = [[peer_ip.decode(), connections] for peer_ip, connections in res.items()]
+    print_table(title, ['Peer', 'Connections'], 'lr', rows, 1)
 
-def parse_watchtower_connections():
+def parse_watchtower_connections(matches):
     res = defaultdict(int)
-    for line in get_logs():
-        match = re.search(REGEX_WATCHTOWER_PEERS, line)
-        if match:
-            res[match.group(1)] += 1
+    for peer_ip, in matches:
+        res[peer_ip] += 1
     return res
 
-def wtclient_failures():
-    res = parse_wtclient_failures()
-    table = PrettyTable()
-    table.field_names = ['Address', 'Error', 'Count']
-    table.align['Address'] = 'l'
-    table.align['Error'] = 'l'
-    table.align['Count'] = 'r'
-    table.sortby = 'Count'
-    table.reversesort = True
-    for address, errors in res.items():
-        for error, count in errors.items():
-            table.add_row([address, error, count])
+def wtclient_failures(title, matches):
+    res = parse_wtclient_failures(matches)
+    rows = [[address.decode(), error.decode(), count] for (address, error), count in res.items()]
+    print_table(title, ['Address', 'Error', 'Count'], 'llr', rows, 2)
+
+def parse_wtclient_failures(matches):
+    return Counter(matches)
+
+def print_table(title, field_names, align, rows, sortby):
+    rows = [[str(value) for value in row] for row in sorted(rows, key=lambda row: [row[sortby]] + row, reverse=True)]
+    widths = [max(display_width(value) for value in column) for column in zip(field_names, *rows)]
+    border = '+' + '+'.join('-' * (width + 2) for width in widths) + '+'
     print()
-    print(table)
+    print(title)
+    print(border)
+    print_table_row(field_names, align, widths)
+    print(border)
+    for row in rows:
+        print_table_row(row, align, widths)
+    print(border)
     print()
 
-def parse_wtclient_failures():
-    res = defaultdict(lambda:defaultdict(int))
-    for line in get_logs():
-        match = re.search(REGEX_WTCLIENT_FAILURES, line)
-        if match:
-            res[match.group(1)][match.group(2)] += 1
-    return res
+def print_table_row(values, align, widths):
+    cells = []
+    for value, a, width in zip(values, align, widths):
+        fill = width - display_width(value)
+        if a == 'l':
+            cells.append(value + ' ' * fill)
+        elif a == 'r':
+            cells.append(' ' * fill + value)
+        else:
+            cells.append(' ' * (fill // 2) + value + ' ' * (fill - fill // 2))
+    print('| ' + ' | '.join(cells) + ' |')
+
+def display_width(text):
+    width = 0
+    for char in text:
+        if unicodedata.combining(char) or unicodedata.category(char) in ('Mn', 'Me', 'Cf', 'Cc'):
+            continue
+        width += 2 if unicodedata.east_asian_width(char) in ('W', 'F') else 1
+    return width
 
 
 ### MAIN SCRIPT ###
 
-cmd = parse_args()
-
-if cmd == 'bandwidth-failures':
-    collect_channel_data()
-    routing_failures(REGEX_BANDWIDTH_FAILURE)
-elif cmd == 'remote-failures':
-    collect_channel_data()
-    routing_failures(REGEX_REMOTE_FAILURE)
-elif cmd == 'watchtower-peers':
-    watchtower_peers()
-elif cmd == 'wtclient-failures':
-    wtclient_failures()
-else:
-    print('Invalid command: ' + cmd)
-    exit(1)
+if __name__ == '__main__':
+    cmds = list(dict.fromkeys(parse_args()))
+    if 'bandwidth-failures' in cmds or 'remote-failures' in cmds:
+        collect_channel_data()
+    matches = scan_logs(cmds)
+    for cmd in cmds:
+        if cmd == 'bandwidth-failures' or cmd == 'remote-failures':
+            routing_failures(COMMAND_TITLES[cmd], matches[cmd])
+        elif cmd == 'watchtower-peers':
+            watchtower_peers(COMMAND_TITLES[cmd], matches[cmd])
+        elif cmd == 'wtclient-failures':
+            wtclient_failures(COMMAND_TITLES[cmd], matches[cmd])
 